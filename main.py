@@ -1,40 +1,105 @@
+import asyncio
+import logging
 import os
-from datetime import datetime, date, timedelta
-from typing import Dict, Optional
-
-from fastapi import FastAPI, HTTPException
+import re
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, date, timedelta, timezone
+from functools import lru_cache
+from typing import Annotated, Dict, FrozenSet, Optional, Tuple
+
+import msgspec
+import orjson
+
+import bson
+from bson import Binary, ObjectId
+from bson.errors import InvalidDocument, InvalidId
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from fastapi.exception_handlers import http_exception_handler
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import ORJSONResponse
+
+from database import db, create_document
+from pricing import compute_quote, ensure_normalized, normalize_boat
 
-from database import db, create_document, get_documents
+logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Boat Renting API", version="1.0.0")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await seed_boats()
+    await ensure_indexes()
+    if db is None:
+        yield
+        return
+    try:
+        await load_boats()
+    except Exception:
+        logger.exception("Failed to prefetch boats")
+    refresher = asyncio.create_task(_boat_refresher())
+    writer = asyncio.create_task(_booking_writer())
+    yield
+    refresher.cancel()
+    await asyncio.gather(refresher, return_exceptions=True)
+    if writer.done():
+        # the writer only stops early on an unexpected error; a sentinel put
+        # would block forever on a full queue
+        if not writer.cancelled() and writer.exception() is not None:
+            logger.error("Booking writer stopped early", exc_info=writer.exception())
+        if not _BOOKING_QUEUE.empty():
+            logger.error("%d booking(s) were never written", _BOOKING_QUEUE.qsize())
+    else:
+        await _BOOKING_QUEUE.put(None)
+        await writer
+
+
+app = FastAPI(
+    title="Boat Renting API",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
-    allow_credentials=True,
+    allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
 
+@app.exception_handler(HTTPException)
+async def release_http_exception(request: Request, exc: HTTPException):
+    response = await http_exception_handler(request, exc)
+    # the preallocated errors below are shared across requests; drop the
+    # frames (and the request data in their locals) once the response exists
+    exc.__traceback__ = None
+    exc.__context__ = None
+    return response
+
+
 # -----------------------------
 # Models for API requests
 # -----------------------------
-class QuoteRequest(BaseModel):
+# Request bodies are decoded and validated by msgspec in C rather than going
+# through FastAPI's Pydantic body handling. The decoders are built once at
+# import; gc=False is safe because the fields can never form a cycle.
+class QuoteRequest(msgspec.Struct, gc=False):
     boat_id: str
     start_date: date
     end_date: date
-    guests: int = Field(ge=1)
+    guests: Annotated[int, msgspec.Meta(ge=1)]
     extras: Dict[str, bool] = {}
 
 
-class BookingRequest(BaseModel):
+class BookingRequest(msgspec.Struct, gc=False):
     boat_id: str
     start_date: date
     end_date: date
-    guests: int = Field(ge=1)
+    guests: Annotated[int, msgspec.Meta(ge=1)]
     customer_name: str
     customer_email: str
     customer_phone: Optional[str] = None
@@ -42,88 +107,269 @@ class BookingRequest(BaseModel):
     notes: Optional[str] = None
 
 
+# strict=False keeps Pydantic's lax coercions, e.g. "guests": "3"
+_quote_decoder = msgspec.json.Decoder(QuoteRequest, strict=False)
+_booking_decoder = msgspec.json.Decoder(BookingRequest, strict=False)
+
+# msgspec reports the failing field as a suffix like " - at `$.extras.fuel`"
+_ERROR_PATH = re.compile(r" - at `\$(.*)`$")
+_PATH_PART = re.compile(r"\.([^.\[]+)|\[(\d+|\.\.\.)\]")
+_MISSING_FIELD = re.compile(r"^Object missing required field `([^`]*)`")
+
+
+def _request_validation_error(e: msgspec.DecodeError) -> RequestValidationError:
+    """Translate a msgspec error into the 422 body FastAPI produced with Pydantic."""
+    if not isinstance(e, msgspec.ValidationError):
+        return RequestValidationError([{"type": "json_invalid", "loc": ["body", 0], "msg": str(e)}])
+    msg = str(e)
+    loc = ["body"]
+    match = _ERROR_PATH.search(msg)
+    if match:
+        for key, index in _PATH_PART.findall(match.group(1)):
+            if index == "...":
+                # msgspec does not name the offending dict key, so the location
+                # stops at the dict itself (e.g. ["body", "extras"])
+                break
+            loc.append(key if key else int(index))
+    missing = _MISSING_FIELD.match(msg)
+    if missing:
+        loc.append(missing.group(1))
+    return RequestValidationError([{"type": "missing" if missing else "value_error", "loc": loc, "msg": msg}])
+
+
+def _request_body(struct: type) -> dict:
+    """OpenAPI requestBody for a msgspec Struct, since FastAPI cannot see it."""
+    _, components = msgspec.json.schema_components([struct])
+    schema = components[struct.__name__]
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": schema}}}}
+
+
+async def parsed_quote(request: Request) -> QuoteRequest:
+    try:
+        return _quote_decoder.decode(await request.body())
+    except msgspec.DecodeError as e:
+        raise _request_validation_error(e)
+
+
+async def parsed_booking(request: Request) -> BookingRequest:
+    try:
+        return _booking_decoder.decode(await request.body())
+    except msgspec.DecodeError as e:
+        raise _request_validation_error(e)
+
+
 # -----------------------------
 # Utility functions
 # -----------------------------
-EXTRA_PRICING = {
-    "skipper": {"type": "per_day", "amount": 150.0},
-    "fuel": {"type": "per_day", "amount": 80.0},
-    "snorkel": {"type": "per_person_per_day", "amount": 20.0},
+# Only the fields the catalog needs leave MongoDB; the id is stringified
+# server-side so no per-document fix-up is needed in Python. Pages are ordered
+# by _id so skip/limit walk the catalog deterministically.
+BOAT_LIST_LIMIT = 200
+BOAT_PUBLIC_PROJECTION = {
+    "_id": 0,
+    "id": {"$toString": "$_id"},
+    "name": 1,
+    "type": 1,
+    "capacity": 1,
+    "base_price_per_day": 1,
+    "location": 1,
+    "images": 1,
+    "description": 1,
+    "features": 1,
+    "tax_rate": 1,
+    "cleaning_fee": 1,
 }
 
-
-def date_range_days(start: date, end: date) -> int:
-    days = (end - start).days
-    if days < 1:
-        raise HTTPException(status_code=400, detail="End date must be after start date by at least 1 day")
-    return days
-
-
-def get_boat_or_404(boat_id: str) -> dict:
-    from bson import ObjectId
+# The boat catalog is small and read on every quote and booking, so the whole
+# collection is kept in-process, loaded at startup and refreshed periodically.
+BOAT_REFRESH_INTERVAL = 60.0
+_BOATS: Dict[str, dict] = {}
+
+# Identical quotes are common (UI re-renders, client retries), so remember the
+# most recent breakdowns keyed by every input that affects the price, together
+# with their orjson encoding for the booking write path.
+QUOTE_CACHE_SIZE = 2048
+_QuoteKey = Tuple[str, date, date, int, FrozenSet[str]]
+_QUOTE_CACHE: "OrderedDict[_QuoteKey, Tuple[dict, bytes]]" = OrderedDict()
+
+# Bookings are written in the background and batched with insert_many; a
+# None on the queue tells the writer to flush and stop. Failed writes are
+# retried with capped exponential backoff (long enough to ride out a primary
+# election), and the queue is bounded so a stalled MongoDB sheds load with 503s
+# instead of growing memory.
+BOOKING_BATCH_SIZE = 100
+BOOKING_FLUSH_INTERVAL = 0.02
+BOOKING_QUEUE_SIZE = 10000
+BOOKING_WRITE_ATTEMPTS = 8
+BOOKING_RETRY_BASE_DELAY = 0.1
+BOOKING_RETRY_MAX_DELAY = 5.0
+_DUPLICATE_KEY = 11000
+_BOOKING_QUEUE: "asyncio.Queue[Optional[dict]]" = asyncio.Queue(maxsize=BOOKING_QUEUE_SIZE)
+
+
+# Static lookup errors are allocated once. with_traceback(None) stops frames
+# from chaining across raises, and release_http_exception drops the last
+# request's frames once its response is built.
+_ERR_BAD_OID = HTTPException(status_code=400, detail="Invalid boat_id")
+_ERR_BOAT_404 = HTTPException(status_code=404, detail="Boat not found")
+
+
+@lru_cache(maxsize=1024)
+def _parse_oid(s: str) -> ObjectId:
+    return ObjectId(s)
+
+
+async def load_boats() -> None:
+    global _BOATS
+    try:
+        boats = await db["boat"].find({}).to_list(length=None)
+    finally:
+        # cached quotes may have been priced from boats that have since changed
+        _QUOTE_CACHE.clear()
+    loaded = {}
+    for boat in boats:
+        try:
+            loaded[str(boat["_id"])] = ensure_normalized(boat)
+        except (TypeError, ValueError, OverflowError):
+            logger.warning("Skipping boat %s with invalid pricing fields", boat["_id"], exc_info=True)
+    _BOATS = loaded
+
+
+async def _boat_refresher() -> None:
+    while True:
+        await asyncio.sleep(BOAT_REFRESH_INTERVAL)
+        try:
+            await load_boats()
+        except Exception:
+            logger.exception("Failed to refresh boats")
+
+
+async def get_boat_or_404(boat_id: str) -> dict:
+    boat = _BOATS.get(boat_id)
+    if boat is not None:
+        return boat
 
     try:
-        oid = ObjectId(boat_id)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid boat_id")
+        oid = _parse_oid(boat_id)
+    except InvalidId:
+        raise _ERR_BAD_OID.with_traceback(None) from None
 
-    boat = db["boat"].find_one({"_id": oid})
+    boat = await db["boat"].find_one({"_id": oid})
     if not boat:
-        raise HTTPException(status_code=404, detail="Boat not found")
+        raise _ERR_BOAT_404.with_traceback(None)
+    _BOATS[boat_id] = ensure_normalized(boat)
     return boat
 
 
-def compute_quote(boat: dict, start: date, end: date, guests: int, extras: Dict[str, bool]):
-    days = date_range_days(start, end)
-
-    base_daily = float(boat.get("base_price_per_day", 0))
-    cleaning_fee = float(boat.get("cleaning_fee", 0.0))
-    tax_rate = float(boat.get("tax_rate", 0.0))
-
-    breakdown = {
-        "nights": days,
-        "base": round(base_daily * days, 2),
-        "extras": {},
-        "cleaning_fee": round(cleaning_fee, 2),
-        "tax": 0.0,
-        "total": 0.0,
-        "currency": "USD",
-        "transparent": True,
-        "notes": "Prices include all fees and taxes. No hidden fees.",
-    }
-
-    extras_total = 0.0
-    for key, enabled in (extras or {}).items():
-        if not enabled:
-            continue
-        rule = EXTRA_PRICING.get(key)
-        if not rule:
-            continue
-        if rule["type"] == "per_day":
-            cost = rule["amount"] * days
-        elif rule["type"] == "per_person_per_day":
-            cost = rule["amount"] * guests * days
-        else:
-            cost = 0.0
-        breakdown["extras"][key] = round(cost, 2)
-        extras_total += cost
+async def cached_quote(
+    boat_id: str, start: date, end: date, guests: int, extras: Dict[str, bool]
+) -> Tuple[dict, bytes]:
+    key = (boat_id, start, end, guests, frozenset(k for k, v in extras.items() if v))
+    entry = _QUOTE_CACHE.get(key)
+    if entry is None:
+        boat = await get_boat_or_404(boat_id)
+        breakdown = compute_quote(boat, start, end, guests, extras)
+        entry = _QUOTE_CACHE[key] = (breakdown, orjson.dumps(breakdown))
+        if len(_QUOTE_CACHE) > QUOTE_CACHE_SIZE:
+            _QUOTE_CACHE.popitem(last=False)
+    else:
+        _QUOTE_CACHE.move_to_end(key)
+    breakdown, encoded = entry
+    # callers add fields to the breakdown, so never hand out the cached dict
+    return {**breakdown, "extras": dict(breakdown["extras"])}, encoded
+
+
+async def _flush_bookings(batch: list) -> None:
+    for attempt in range(BOOKING_WRITE_ATTEMPTS):
+        try:
+            await db["booking"].insert_many(batch, ordered=False)
+            return
+        except BulkWriteError as e:
+            # the insert is unordered, so only documents listed in writeErrors
+            # failed; _ids are generated here, so a duplicate key means an
+            # earlier attempt already wrote that booking
+            if e.details.get("writeConcernErrors"):
+                pending = batch
+            else:
+                pending = [
+                    batch[err["index"]] for err in e.details.get("writeErrors", []) if err.get("code") != _DUPLICATE_KEY
+                ]
+            if not pending:
+                return
+            batch = pending
+            logger.warning("Booking write attempt %d failed for %d booking(s)", attempt + 1, len(batch), exc_info=True)
+        except PyMongoError:
+            logger.warning("Booking write attempt %d failed for %d booking(s)", attempt + 1, len(batch), exc_info=True)
+        except Exception:
+            # not a driver/server error, so retrying cannot help; drop the batch
+            # rather than let the writer task die and strand the queue
+            logger.exception(
+                "Dropping %d booking(s) that could not be written: %s",
+                len(batch),
+                ", ".join(str(doc["_id"]) for doc in batch),
+            )
+            return
+        if attempt + 1 < BOOKING_WRITE_ATTEMPTS:
+            await asyncio.sleep(min(BOOKING_RETRY_BASE_DELAY * 2**attempt, BOOKING_RETRY_MAX_DELAY))
+    logger.error(
+        "Giving up on %d booking(s) after %d attempts: %s",
+        len(batch),
+        BOOKING_WRITE_ATTEMPTS,
+        ", ".join(str(doc["_id"]) for doc in batch),
+    )
+
+
+async def _booking_writer() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        doc = await _BOOKING_QUEUE.get()
+        if doc is None:
+            return
+        batch = [doc]
+        stop = False
+        deadline = loop.time() + BOOKING_FLUSH_INTERVAL
+        while len(batch) < BOOKING_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                doc = await asyncio.wait_for(_BOOKING_QUEUE.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if doc is None:
+                stop = True
+                break
+            batch.append(doc)
+        await _flush_bookings(batch)
+        if stop:
+            return
 
-    subtotal = breakdown["base"] + extras_total + breakdown["cleaning_fee"]
-    breakdown["tax"] = round(subtotal * tax_rate, 2)
-    breakdown["total"] = round(subtotal + breakdown["tax"], 2)
 
-    return breakdown
+async def ensure_indexes():
+    try:
+        if db is None:
+            return
+        # serves availability checks of the form
+        # {"boat_id": ..., "start_date": {"$lt": end}, "end_date": {"$gt": start}}
+        await db["booking"].create_index([("boat_id", 1), ("start_date", 1), ("end_date", 1)])
+    except Exception:
+        # index creation is best-effort, like seeding
+        pass
 
 
 # -----------------------------
 # Seed data on first run
 # -----------------------------
-@app.on_event("startup")
-def seed_boats():
+async def seed_boats():
     try:
         if db is None:
             return
-        count = db["boat"].count_documents({})
+        # a unique name keeps concurrent first-boot seeding idempotent; boats
+        # posted without a string name are left out of the index
+        await db["boat"].create_index(
+            "name", unique=True, partialFilterExpression={"name": {"$type": "string"}}
+        )
+        count = await db["boat"].estimated_document_count()
         if count == 0:
             sample_boats = [
                 {
@@ -169,7 +415,7 @@ def seed_boats():
                     "cleaning_fee": 25.0,
                 },
             ]
-            db["boat"].insert_many(sample_boats)
+            await db["boat"].insert_many([normalize_boat(b) for b in sample_boats], ordered=False)
     except Exception:
         # seeding is best-effort
         pass
@@ -184,7 +430,7 @@ def root():
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -200,7 +446,7 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, "name") else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = await db.list_collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -216,51 +462,71 @@ def test_database():
 # Boats
 # -----------------------------
 @app.get("/api/boats")
-def list_boats():
-    docs = get_documents("boat") if db is not None else []
-    # convert ObjectId to str
-    def to_public(doc):
-        doc["id"] = str(doc.pop("_id"))
-        return doc
-    return [to_public(d) for d in docs]
+async def list_boats(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(BOAT_LIST_LIMIT, ge=1, le=BOAT_LIST_LIMIT),
+):
+    if db is None:
+        return []
+    cursor = db["boat"].aggregate([
+        {"$sort": {"_id": 1}},
+        {"$skip": skip},
+        {"$limit": limit},
+        {"$project": BOAT_PUBLIC_PROJECTION},
+    ])
+    return await cursor.to_list(length=None)
 
 
 @app.post("/api/boats")
-def create_boat(boat: Dict):
+async def create_boat(boat: Dict):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    boat_id = create_document("boat", boat)
+    try:
+        normalize_boat(boat)
+    except (TypeError, ValueError, OverflowError):
+        raise HTTPException(
+            status_code=422, detail="base_price_per_day, cleaning_fee and tax_rate must be finite numbers"
+        )
+    try:
+        boat_id = await create_document("boat", boat)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="A boat with this name already exists")
+    # create_document inserts a copy, so boat only has an _id if the client
+    # supplied one (which need not be an ObjectId)
+    boat.setdefault("_id", ObjectId(boat_id))
+    _BOATS[boat_id] = boat
     return {"id": boat_id}
 
 
 # -----------------------------
 # Pricing / Quote
 # -----------------------------
-@app.post("/api/quote")
-def quote(req: QuoteRequest):
+@app.post("/api/quote", openapi_extra=_request_body(QuoteRequest))
+async def quote(req: QuoteRequest = Depends(parsed_quote)):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    boat = get_boat_or_404(req.boat_id)
-    breakdown = compute_quote(boat, req.start_date, req.end_date, req.guests, req.extras)
+    breakdown, _ = await cached_quote(req.boat_id, req.start_date, req.end_date, req.guests, req.extras)
     breakdown["boat_id"] = req.boat_id
-    return breakdown
+    # returning the response directly skips FastAPI's jsonable_encoder pass
+    return ORJSONResponse(breakdown)
 
 
 # -----------------------------
 # Bookings
 # -----------------------------
-@app.post("/api/bookings")
-def create_booking(req: BookingRequest):
+@app.post("/api/bookings", openapi_extra=_request_body(BookingRequest))
+async def create_booking(req: BookingRequest = Depends(parsed_booking)):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
 
-    boat = get_boat_or_404(req.boat_id)
-    pricing = compute_quote(boat, req.start_date, req.end_date, req.guests, req.extras)
+    pricing, pricing_bytes = await cached_quote(req.boat_id, req.start_date, req.end_date, req.guests, req.extras)
 
+    now = datetime.now(timezone.utc)
     booking_doc = {
+        "_id": ObjectId(),
         "boat_id": req.boat_id,
-        "start_date": req.start_date.isoformat(),
-        "end_date": req.end_date.isoformat(),
+        "start_date": datetime.combine(req.start_date, datetime.min.time()),
+        "end_date": datetime.combine(req.end_date, datetime.min.time()),
         "guests": req.guests,
         "customer_name": req.customer_name,
         "customer_email": req.customer_email,
@@ -268,16 +534,31 @@ def create_booking(req: BookingRequest):
         "extras": req.extras,
         "notes": req.notes,
         "pricing": pricing,
+        "pricing_blob": Binary(pricing_bytes),
         "status": "requested",
-        "created_at": datetime.utcnow().isoformat(),
+        "created_at": now,
+        "updated_at": now,
     }
 
-    booking_id = create_document("booking", booking_doc)
-    return {"id": booking_id, "status": "requested", "pricing": pricing}
+    # the write happens after the response, so reject anything MongoDB
+    # would refuse to encode (e.g. NUL bytes in extras keys) while we still can
+    try:
+        bson.encode(booking_doc)
+    except (InvalidDocument, OverflowError) as e:
+        raise HTTPException(status_code=422, detail=f"Booking cannot be stored: {e}")
+
+    # "requested" bookings are eventually consistent, so the id is generated
+    # here and returned before the batched write lands
+    try:
+        _BOOKING_QUEUE.put_nowait(booking_doc)
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Bookings are temporarily unavailable, please retry")
+    return ORJSONResponse({"id": str(booking_doc["_id"]), "status": "requested", "pricing": pricing})
 
 
 if __name__ == "__main__":
     import uvicorn
 
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 2))
+    uvicorn.run("main:app", host="0.0.0.0", port=port, loop="uvloop", http="httptools", workers=workers)
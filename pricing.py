@@ -0,0 +1,108 @@
+"""
+Pricing
+
+Quote computation for boat rentals. Kept free of I/O so it can be compiled
+with Cython (see setup.py) for the hot /api/quote and /api/bookings paths;
+the pure-Python module is used as-is when no extension has been built.
+"""
+
+from datetime import date
+from fractions import Fraction
+from typing import Dict, Tuple
+
+from fastapi import HTTPException
+
+# (per_day, per_person_per_day) rates for each extra in cents, so the cost is
+# a single integer expression instead of a branch on the pricing rule type.
+_EXTRA_RATES: Dict[str, Tuple[int, int]] = {
+    "skipper": (15000, 0),
+    "fuel": (8000, 0),
+    "snorkel": (0, 2000),
+}
+
+
+# Tax rates are kept as an exact num/den pair taken from the rate's decimal
+# form (0.08875 -> 71/800), so only the final tax amount is ever rounded. The
+# denominator cap keeps both ints within BSON's int64 for any sane rate.
+_TAX_RATE_MAX_DENOMINATOR = 10**12
+_INT64_MAX = 2**63 - 1
+
+
+# Raised often enough on bad input to be worth allocating once. The traceback
+# is reset on each raise; main.release_http_exception clears it again after
+# the response is built so the last request's frames are not kept alive.
+_ERR_BAD_RANGE = HTTPException(status_code=400, detail="End date must be after start date by at least 1 day")
+
+
+def normalize_boat(doc: dict) -> dict:
+    """Coerce pricing fields once at write time so quotes can read them as-is.
+
+    The public fields stay floats; integer cents and the exact tax rate as a
+    numerator/denominator pair are stored next to them for compute_quote.
+    """
+    doc["base_price_per_day"] = float(doc.get("base_price_per_day", 0))
+    doc["cleaning_fee"] = float(doc.get("cleaning_fee", 0.0))
+    doc["tax_rate"] = float(doc.get("tax_rate", 0.0))
+    doc["base_price_cents"] = round(doc["base_price_per_day"] * 100)
+    doc["cleaning_fee_cents"] = round(doc["cleaning_fee"] * 100)
+    tax_rate = Fraction(repr(doc["tax_rate"])).limit_denominator(_TAX_RATE_MAX_DENOMINATOR)
+    if abs(tax_rate.numerator) > _INT64_MAX:
+        raise ValueError(f"tax_rate {doc['tax_rate']!r} is out of range")
+    doc["tax_rate_num"] = tax_rate.numerator
+    doc["tax_rate_den"] = tax_rate.denominator
+    return doc
+
+
+def ensure_normalized(doc: dict) -> dict:
+    """Normalize a boat read back from MongoDB if it was stored before
+    normalize_boat ran on insert. Raises the same errors as normalize_boat."""
+    if "tax_rate_den" not in doc:
+        normalize_boat(doc)
+    return doc
+
+
+def date_range_days(start: date, end: date) -> int:
+    days = (end - start).days
+    if days < 1:
+        raise _ERR_BAD_RANGE.with_traceback(None)
+    return days
+
+
+def compute_quote(boat: dict, start: date, end: date, guests: int, extras: Dict[str, bool]):
+    days = date_range_days(start, end)
+
+    # all arithmetic is in integer cents; floats only appear in the output
+    base_cents = boat["base_price_cents"] * days
+    cleaning_cents = boat["cleaning_fee_cents"]
+
+    extras_breakdown = {}
+    extras_cents = 0
+    # most quotes select no extras, so skip the loop entirely in that case
+    if extras and any(extras.values()):
+        for key, enabled in extras.items():
+            if not enabled:
+                continue
+            rates = _EXTRA_RATES.get(key)
+            if rates is None:
+                continue
+            per_day, per_person = rates
+            cost = (per_day + per_person * guests) * days
+            extras_breakdown[key] = cost / 100
+            extras_cents += cost
+
+    subtotal_cents = base_cents + extras_cents + cleaning_cents
+    # exact rational tax, rounded half up to the cent
+    tax_den = boat["tax_rate_den"]
+    tax_cents = (2 * subtotal_cents * boat["tax_rate_num"] + tax_den) // (2 * tax_den)
+
+    return {
+        "nights": days,
+        "base": base_cents / 100,
+        "extras": extras_breakdown,
+        "cleaning_fee": cleaning_cents / 100,
+        "tax": tax_cents / 100,
+        "total": (subtotal_cents + tax_cents) / 100,
+        "currency": "USD",
+        "transparent": True,
+        "notes": "Prices include all fees and taxes. No hidden fees.",
+    }
@@ -0,0 +1,16 @@
+"""
+Optional native build of the pricing module.
+
+    python setup.py build_ext --inplace
+
+compiles pricing.py with Cython in pure-Python mode; main.py imports the
+resulting extension transparently and falls back to the .py source otherwise.
+"""
+
+from Cython.Build import cythonize
+from setuptools import setup
+
+setup(
+    name="boat-renting-api-pricing",
+    ext_modules=cythonize(["pricing.py"], language_level=3),
+)